@@ -92,13 +92,26 @@ def get_clotho_loader(split: str,
 
     shuffle = settings_data['shuffle'] if is_training else False
     drop_last = settings_data['drop_last'] if is_training else False
+    num_workers = settings_data['num_workers']
+
+    # Prefetching and persistent workers are only valid
+    # with worker processes.
+    workers_kwargs = {}
+    if num_workers > 0:
+        if settings_data['prefetch_factor'] is not None:
+            workers_kwargs.update(
+                {'prefetch_factor': settings_data['prefetch_factor']})
+        if settings_data['persistent_workers']:
+            workers_kwargs.update({'persistent_workers': True})
 
     return DataLoader(
         dataset=dataset,
         batch_size=settings_data['batch_size'],
         shuffle=shuffle,
-        num_workers=settings_data['num_workers'],
+        num_workers=num_workers,
         drop_last=drop_last,
-        collate_fn=_clotho_collate_fn)
+        collate_fn=_clotho_collate_fn,
+        pin_memory=settings_data['pin_memory'],
+        **workers_kwargs)
 
 # EOF
@@ -2,22 +2,29 @@
 # -*- coding: utf-8 -*-
 
 from pathlib import Path
-import pickle
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pickle import HIGHEST_PROTOCOL
+from random import sample
 from time import time
 from typing import MutableMapping, MutableSequence,\
     Any, Union, List, Dict, Tuple
 
-from torch import Tensor, no_grad, save as pt_save, \
-    load as pt_load, randperm
+from torch import Tensor, backends, save as pt_save
 from torch.nn import CrossEntropyLoss, Module
 from torch.optim import Adam
-from torch.nn.functional import softmax
 from loguru import logger
 
+try:
+    from torch import inference_mode
+except ImportError:
+    # PyTorch older than 1.9
+    from torch import no_grad as inference_mode
+
 from tools import file_io, printing, csv_functions
 from tools.argument_parsing import get_argument_parser
 from tools.model import module_epoch_passing, get_model,\
-    get_device
+    get_device, get_grad_scaler, compile_model
 from data_handlers.clotho_loader import get_clotho_loader
 from eval_metrics import evaluate_metrics
 
@@ -27,6 +34,24 @@ __docformat__ = 'reStructuredText'
 __all__ = ['method']
 
 
+def _copy_to_cpu(obj: Any) \
+        -> Any:
+    """Copies the tensors of a (nested) state dict to CPU.
+
+    :param obj: State dict, or an element of it.
+    :type obj: dict|list|tuple|torch.Tensor|object
+    :return: Copy of the object, with tensors on CPU.
+    :rtype: dict|list|tuple|torch.Tensor|object
+    """
+    if isinstance(obj, Tensor):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return {k: _copy_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_cpu(v) for v in obj)
+    return obj
+
+
 def _decode_outputs(predicted_outputs: MutableSequence[Tensor],
                     ground_truth_outputs: MutableSequence[Tensor],
                     indices_object: MutableSequence[str],
@@ -36,7 +61,7 @@ def _decode_outputs(predicted_outputs: MutableSequence[Tensor],
         -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
     """Decodes predicted output to string.
 
-    :param predicted_outputs: Predicted outputs.
+    :param predicted_outputs: Predicted outputs (indices).
     :type predicted_outputs: list[torch.Tensor]
     :param ground_truth_outputs: Ground truth outputs.
     :type ground_truth_outputs: list[torch.Tensor]
@@ -57,65 +82,53 @@ def _decode_outputs(predicted_outputs: MutableSequence[Tensor],
     main_logger.info('Starting decoding of captions')
     text_sep = '-' * 100
 
-    captions_pred: List[Dict] = []
-    captions_gt: List[Dict] = []
-    f_names: List[str] = []
+    pred_map: Dict[str, str] = {}
+    gt_map: Dict[str, List[str]] = defaultdict(list)
 
     if print_to_console:
         main_logger.info(f'{text_sep}\n{text_sep}\n{text_sep}\n\n')
 
-    for gt_words, b_predictions, f_name in zip(
-            ground_truth_outputs, predicted_outputs, file_names):
-        predicted_words = softmax(b_predictions, dim=-1).argmax(1)
-
-        predicted_caption = [indices_object[i.item()]
-                             for i in predicted_words]
-        gt_caption = [indices_object[i.item()]
-                      for i in gt_words]
+    indices_tuple = tuple(indices_object)
+    eos_id = indices_tuple.index(eos_token)
+    pred_ids_all = [i.tolist() for i in predicted_outputs]
+    gt_ids_all = [i.tolist() for i in ground_truth_outputs]
 
-        gt_caption = gt_caption[:gt_caption.index(eos_token)]
+    for gt_ids, pred_ids, f_name in zip(
+            gt_ids_all, pred_ids_all, file_names):
+        gt_ids = gt_ids[:gt_ids.index(eos_id)]
         try:
-            predicted_caption = predicted_caption[
-                                :predicted_caption.index(eos_token)]
+            pred_ids = pred_ids[:pred_ids.index(eos_id)]
         except ValueError:
             pass
 
-        predicted_caption = ' '.join(predicted_caption)
-        gt_caption = ' '.join(gt_caption)
-
-        f_n = f_name.stem.split('.')[0]
-
-        if f_n not in f_names:
-            f_names.append(f_n)
-            captions_pred.append({
-                'file_name': f_n,
-                'caption_predicted': predicted_caption})
-            captions_gt.append({
-                'file_name': f_n,
-                'caption_1': gt_caption})
-        else:
-            for d_i, d in enumerate(captions_gt):
-                if f_n == d['file_name']:
-                    len_captions = len([i_c for i_c in d.keys()
-                                        if i_c.startswith('caption_')]) + 1
-                    d.update({f'caption_{len_captions}': gt_caption})
-                    captions_gt[d_i] = d
-                    break
-
-        log_strings = [f'Captions for file {f_name.stem}: ',
-                       f'\tPredicted caption: {predicted_caption}',
-                       f'\tOriginal caption: {gt_caption}\n\n']
-
-        [caption_logger.info(log_string)
-         for log_string in log_strings]
+        predicted_caption = ' '.join(indices_tuple[i] for i in pred_ids)
+        gt_caption = ' '.join(indices_tuple[i] for i in gt_ids)
+
+        f_n = f_name.stem
+
+        # Keep the first prediction for each file
+        pred_map.setdefault(f_n, predicted_caption)
+        gt_map[f_n].append(gt_caption)
+
+        log_string = f'Captions for file {f_name.stem}: \n' \
+                     f'\tPredicted caption: {predicted_caption}\n' \
+                     f'\tOriginal caption: {gt_caption}\n\n'
+
+        caption_logger.info(log_string)
 
         if print_to_console:
-            [main_logger.info(log_string)
-             for log_string in log_strings]
+            main_logger.info(log_string)
 
     if print_to_console:
         main_logger.info(f'{text_sep}\n{text_sep}\n{text_sep}\n\n')
 
+    captions_pred: List[Dict] = [
+        {'file_name': k, 'caption_predicted': v}
+        for k, v in pred_map.items()]
+    captions_gt: List[Dict] = [
+        {'file_name': k, **{f'caption_{i + 1}': c for i, c in enumerate(v)}}
+        for k, v in gt_map.items()]
+
     logger.bind(is_caption=False, indent=0).info(
         'Decoding of captions ended')
 
@@ -125,7 +138,8 @@ def _decode_outputs(predicted_outputs: MutableSequence[Tensor],
 def _do_testing(model: Module,
                 settings_data:  MutableMapping[str, Any],
                 settings_io:  MutableMapping[str, Any],
-                indices_list: MutableSequence[str]) \
+                indices_list: MutableSequence[str],
+                use_amp: bool) \
         -> None:
     """Evaluation of an optimized model.
 
@@ -135,15 +149,12 @@ def _do_testing(model: Module,
     :type settings_data: dict
     :param indices_list: Sequence with the words of the captions.
     :type indices_list: list[str]
+    :param use_amp: Use mixed precision?
+    :type use_amp: bool
     """
     model.eval()
     logger_main = logger.bind(is_caption=False, indent=1)
 
-    data_path_test = Path(
-        settings_io['root_dirs']['data'],
-        settings_io['dataset']['features_dirs']['output'],
-        settings_io['dataset']['features_dirs']['test'])
-
     logger_main.info('Getting test data')
     test_data = get_clotho_loader(
         settings_io['dataset']['features_dirs']['test'],
@@ -161,23 +172,23 @@ def _do_testing(model: Module,
     logger.bind(is_caption=True, indent=0).info(
         f'{starting_text}.\n\n')
 
-    with no_grad():
+    with inference_mode():
         test_outputs = module_epoch_passing(
             data=test_data, module=model,
-            objective=None, optimizer=None)
+            objective=None, optimizer=None,
+            use_amp=use_amp)
 
     captions_pred, _ = _decode_outputs(
         test_outputs[1],
         test_outputs[2],
         indices_object=indices_list,
-        file_names=list(data_path_test.iterdir()),
+        file_names=[Path(i) for i in test_outputs[3]],
         eos_token='<eos>',
         print_to_console=False)
 
-    # clotho_file_{file_name} to {file_name}.wav
+    # {file_name} to {file_name}.wav
     for i, entry in enumerate(captions_pred):
-        entry['file_name'] = entry['file_name']\
-            .replace('clotho_file_', '') + '.wav'
+        entry['file_name'] = f'{entry["file_name"]}.wav'
         captions_pred[i] = entry
 
     submission_dir = Path().joinpath(
@@ -196,7 +207,8 @@ def _do_testing(model: Module,
 def _do_evaluation(model: Module,
                    settings_data:  MutableMapping[str, Any],
                    settings_io:  MutableMapping[str, Any],
-                   indices_list: MutableSequence[str]) \
+                   indices_list: MutableSequence[str],
+                   use_amp: bool) \
         -> None:
     """Evaluation of an optimized model.
 
@@ -206,15 +218,12 @@ def _do_evaluation(model: Module,
     :type settings_data: dict
     :param indices_list: Sequence with the words of the captions.
     :type indices_list: list[str]
+    :param use_amp: Use mixed precision?
+    :type use_amp: bool
     """
     model.eval()
     logger_main = logger.bind(is_caption=False, indent=1)
 
-    data_path_evaluation = Path(
-        settings_io['root_dirs']['data'],
-        settings_io['dataset']['features_dirs']['output'],
-        settings_io['dataset']['features_dirs']['evaluation'])
-
     logger_main.info('Getting evaluation data')
     validation_data = get_clotho_loader(
         settings_io['dataset']['features_dirs']['evaluation'],
@@ -232,16 +241,17 @@ def _do_evaluation(model: Module,
     logger.bind(is_caption=True, indent=0).info(
         f'{starting_text}.\n\n')
 
-    with no_grad():
+    with inference_mode():
         evaluation_outputs = module_epoch_passing(
             data=validation_data, module=model,
-            objective=None, optimizer=None)
+            objective=None, optimizer=None,
+            use_amp=use_amp)
 
     captions_pred, captions_gt = _decode_outputs(
         evaluation_outputs[1],
         evaluation_outputs[2],
         indices_object=indices_list,
-        file_names=sorted(list(data_path_evaluation.iterdir())),
+        file_names=[Path(i) for i in evaluation_outputs[3]],
         eos_token='<eos>',
         print_to_console=False)
 
@@ -287,6 +297,7 @@ def _do_training(model: Module,
     loss_thr: float = settings_training['loss_thr']
     patience_counter = 0
     best_epoch = 0
+    best_state_dict = None
 
     # Initialize logger
     logger_main = logger.bind(is_caption=False, indent=1)
@@ -307,117 +318,123 @@ def _do_training(model: Module,
     objective = CrossEntropyLoss()
     optimizer = Adam(params=model.parameters(),
                      lr=settings_training['optimizer']['lr'])
+    scaler = get_grad_scaler(settings_training['amp'])
 
     # Inform that we start training
     logger_main.info('Starting training')
 
     model.train()
-    for epoch in range(settings_training['nb_epochs']):
-
-        # Log starting time
-        start_time = time()
-
-        # Do a complete pass over our training data
-        epoch_output = module_epoch_passing(
-            data=training_data,
-            module=model,
-            objective=objective,
-            optimizer=optimizer,
-            grad_norm=settings_training['grad_norm']['norm'],
-            grad_norm_val=settings_training['grad_norm']['value'])
-        objective_output, output_y_hat, output_y, f_names = epoch_output
-
-        # Get mean loss of training and print it with logger
-        training_loss = objective_output.mean().item()
-
-        logger_main.info(f'Epoch: {epoch:05d} -- '
-                         f'Training loss: {training_loss:>7.4f} | '
-                         f'Time: {time() - start_time:>5.3f}')
-
-        # Check if we have to decode captions for the current epoch
-        if divmod(epoch + 1,
-                  settings_training['text_output_every_nb_epochs'])[-1] == 0:
-
-            # Get the subset of files for decoding their captions
-            sampling_indices = sorted(randperm(len(output_y_hat))
-                                      [:settings_training['nb_examples_to_sample']]
-                                      .tolist())
-
-            # Do the decoding
-            _decode_outputs(*zip(*[[output_y_hat[i], output_y[i]]
-                                 for i in sampling_indices]),
-                            indices_object=indices_list,
-                            file_names=[Path(f_names[i_f_name])
-                                        for i_f_name in sampling_indices],
-                            eos_token='<eos>',
-                            print_to_console=False)
-
-        # Check improvement of loss
-        if prv_training_loss - training_loss > loss_thr:
-            # Log the current loss
-            prv_training_loss = training_loss
-
-            # Log the current epoch
-            best_epoch = epoch
-
-            # Serialize the model keeping the epoch
-            pt_save(
-                model.state_dict(),
-                str(model_dir.joinpath(
-                    f'epoch_{best_epoch:05d}_{model_file_name}')))
-
-            # Zero out the patience
-            patience_counter = 0
-
-        else:
-
-            # Increase patience counter
-            patience_counter += 1
-
-        # Serialize the model and optimizer.
-        for pt_obj, save_str in zip([model, optimizer], ['', '_optimizer']):
-            pt_save(
-                pt_obj.state_dict(),
-                str(model_dir.joinpath(
-                    f'latest{save_str}_{model_file_name}')))
-
-        # Check for stopping criteria
-        if patience_counter >= patience:
-            logger_main.info('No lower training loss for '
-                             f'{patience_counter} epochs. '
-                             'Training stops.')
-            break
+
+    # Serialization happens in the background, while training goes on
+    pending_saves = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for epoch in range(settings_training['nb_epochs']):
+
+            # Log starting time
+            start_time = time()
+
+            # Do a complete pass over our training data
+            epoch_output = module_epoch_passing(
+                data=training_data,
+                module=model,
+                objective=objective,
+                optimizer=optimizer,
+                grad_norm=settings_training['grad_norm']['norm'],
+                grad_norm_val=settings_training['grad_norm']['value'],
+                use_amp=settings_training['amp'],
+                scaler=scaler)
+            objective_output, output_y_hat, output_y, f_names = epoch_output
+
+            # Get mean loss of training and print it with logger
+            training_loss = objective_output.mean().item()
+
+            logger_main.info(f'Epoch: {epoch:05d} -- '
+                             f'Training loss: {training_loss:>7.4f} | '
+                             f'Time: {time() - start_time:>5.3f}')
+
+            # Check if we have to decode captions for the current epoch
+            if divmod(epoch + 1,
+                      settings_training['text_output_every_nb_epochs'])[-1] == 0:
+
+                # Get the subset of files for decoding their captions
+                sampling_indices = sorted(sample(
+                    range(len(output_y_hat)),
+                    min(settings_training['nb_examples_to_sample'],
+                        len(output_y_hat))))
+
+                # Do the decoding
+                _decode_outputs(predicted_outputs=[output_y_hat[i]
+                                                   for i in sampling_indices],
+                                ground_truth_outputs=[output_y[i]
+                                                      for i in sampling_indices],
+                                indices_object=indices_list,
+                                file_names=[Path(f_names[i_f_name])
+                                            for i_f_name in sampling_indices],
+                                eos_token='<eos>',
+                                print_to_console=False)
+
+            # Check improvement of loss
+            if prv_training_loss - training_loss > loss_thr:
+                # Log the current loss
+                prv_training_loss = training_loss
+
+                # Log the current epoch
+                best_epoch = epoch
+
+                # Keep the weights of the best model in memory
+                best_state_dict = _copy_to_cpu(model.state_dict())
+
+                # Zero out the patience
+                patience_counter = 0
+
+            else:
+
+                # Increase patience counter
+                patience_counter += 1
+
+            # Wait for the serializations of the previous epoch,
+            # raising their errors, before making new ones.
+            for future in pending_saves:
+                future.result()
+
+            # Serialize the model and optimizer.
+            pending_saves = [
+                executor.submit(
+                    pt_save,
+                    _copy_to_cpu(pt_obj.state_dict()),
+                    str(model_dir.joinpath(
+                        f'latest{save_str}_{model_file_name}')),
+                    pickle_protocol=HIGHEST_PROTOCOL)
+                for pt_obj, save_str in zip([model, optimizer],
+                                            ['', '_optimizer'])]
+
+            # Check for stopping criteria
+            if patience_counter >= patience:
+                logger_main.info('No lower training loss for '
+                                 f'{patience_counter} epochs. '
+                                 'Training stops.')
+                break
 
     # Inform that we are done
     logger_main.info('Training done')
 
-    # Load best model
-    model.load_state_dict(pt_load(
-        str(model_dir.joinpath(
-            f'epoch_{best_epoch:05d}_{model_file_name}'))))
-
-
-def _get_nb_output_classes(settings: MutableMapping[str, Any]) \
-        -> int:
-    """Gets the amount of output classes.
+    # Raise errors of the last serializations
+    for future in pending_saves:
+        future.result()
 
-    :param settings: Settings to use.
-    :type settings: dict
-    :return: Amount of output classes.
-    :rtype: int
-    """
-    f_name_field = 'words_list_file_name' \
-        if settings['data']['output_field_name'].startswith('words') \
-        else 'characters_list_file_name'
+    if best_state_dict is None:
+        logger_main.error('No epoch improved the training loss, '
+                          'no best model to load.')
+        raise RuntimeError('Training did not improve the loss (e.g. zero '
+                           'epochs or NaN loss); there is no best model.')
 
-    f_name = settings['data']['files'][f_name_field]
-    path = Path(
-        settings['data']['files']['root_dir'],
-        settings['data']['files']['dataset_dir'],
-        f_name)
-
-    with path.open('rb') as f:
-        return len(pickle.load(f))
+    # Load best model and serialize it keeping the epoch
+    model.load_state_dict(best_state_dict)
+    pt_save(
+        best_state_dict,
+        str(model_dir.joinpath(
+            f'epoch_{best_epoch:05d}_{model_file_name}')),
+        pickle_protocol=HIGHEST_PROTOCOL)
 
 
 def _load_indices_file(settings_files: MutableMapping[str, Any],
@@ -456,6 +473,16 @@ def method(settings: MutableMapping[str, Any]) \
     device, device_name = get_device(
         settings['dnn_training_settings']['training']['force_cpu'])
 
+    if device == 'cuda':
+        # The baseline has no convolutions and its time-steps change per
+        # batch, so benchmark is effectively a no-op for it. TF32 applies
+        # to the GRU and linear layers on Ampere or newer GPUs.
+        backends.cudnn.benchmark = True
+        backends.cudnn.allow_tf32 = True
+        # PyTorch older than 1.7 has no TF32 matmul flag
+        if hasattr(backends.cuda, 'matmul'):
+            backends.cuda.matmul.allow_tf32 = True
+
     model_dir = Path(
         settings['dirs_and_files']['root_dirs']['outputs'],
         settings['dirs_and_files']['model']['model_dir'])
@@ -488,6 +515,8 @@ def method(settings: MutableMapping[str, Any]) \
             output_classes=len(indices_list),
             device=device)
         model.to(device)
+        compile_model(
+            model, settings['dnn_training_settings']['training']['compile'])
         logger_inner.info('Done\n')
 
         logger_inner.info(f'Model:\n{model}\n')
@@ -518,6 +547,8 @@ def method(settings: MutableMapping[str, Any]) \
                 output_classes=len(indices_list),
                 device=device)
             model.to(device)
+            compile_model(
+                model, settings['dnn_training_settings']['training']['compile'])
             logger_inner.info('Model ready')
 
         logger_inner.info('Starting evaluation')
@@ -525,7 +556,8 @@ def method(settings: MutableMapping[str, Any]) \
             model=model,
             settings_data=settings['dnn_training_settings']['data'],
             settings_io=settings['dirs_and_files'],
-            indices_list=indices_list)
+            indices_list=indices_list,
+            use_amp=settings['dnn_training_settings']['training']['amp'])
         logger_inner.info('Evaluation done')
 
     if settings['workflow']['dnn_testing']:
@@ -542,6 +574,8 @@ def method(settings: MutableMapping[str, Any]) \
                 output_classes=len(indices_list),
                 device=device)
             model.to(device)
+            compile_model(
+                model, settings['dnn_training_settings']['training']['compile'])
             logger_inner.info('Model ready')
 
         logger_inner.info('Starting testing')
@@ -549,7 +583,8 @@ def method(settings: MutableMapping[str, Any]) \
             model=model,
             settings_data=settings['dnn_training_settings']['data'],
             settings_io=settings['dirs_and_files'],
-            indices_list=indices_list)
+            indices_list=indices_list,
+            use_amp=settings['dnn_training_settings']['training']['amp'])
         logger_inner.info('Testing done')
 
 
@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 from typing import Tuple, MutableSequence, \
-    Callable, Optional, List, Union, MutableMapping
+    Callable, Optional, List, Union, MutableMapping, Any
+from contextlib import nullcontext
 from platform import processor
 from pathlib import Path
 
@@ -16,11 +17,30 @@ from models import BaselineDCASE
 
 __author__ = 'Konstantinos Drossos -- Tampere University'
 __docformat__ = 'reStructuredText'
-__all__ = ['get_device', 'get_model',
+__all__ = ['compile_model', 'get_device',
+           'get_grad_scaler', 'get_model',
            'module_epoch_passing',
            'module_forward_passing']
 
 
+def compile_model(model: Module,
+                  use_compile: bool) \
+        -> None:
+    """Compiles, in place, the model if specified.
+
+    The default compilation mode is used, as the\
+    time-steps change from batch to batch and CUDA\
+    graphs would be re-recorded for every new shape.
+
+    :param model: Model to compile.
+    :type model: torch.nn.Module
+    :param use_compile: Compile the model? Needs PyTorch 2.2 or newer.
+    :type use_compile: bool
+    """
+    if use_compile:
+        model.compile()
+
+
 def get_device(force_cpu: bool) \
         -> Tuple[str, str]:
     """Gets the available device.
@@ -35,6 +55,25 @@ def get_device(force_cpu: bool) \
         ('cpu', processor())
 
 
+def get_grad_scaler(use_amp: bool) \
+        -> Union[Any, None]:
+    """Gets the gradient scaler for mixed precision training.
+
+    The scaler is imported only if mixed precision is\
+    used, as it needs PyTorch 1.6 or newer.
+
+    :param use_amp: Use mixed precision?
+    :type use_amp: bool
+    :return: Gradient scaler, or None if not using mixed precision.
+    :rtype: torch.cuda.amp.GradScaler|None
+    """
+    if not use_amp:
+        return None
+
+    from torch.cuda.amp import GradScaler
+    return GradScaler()
+
+
 def get_model(settings_model: MutableMapping[str, Union[str, MutableMapping]],
               settings_io: MutableMapping[str, Union[str, MutableMapping]],
               output_classes: int,
@@ -76,7 +115,9 @@ def module_epoch_passing(data: DataLoader,
                          objective: Union[Callable[[Tensor, Tensor], Tensor], None],
                          optimizer: Union[Optimizer, None],
                          grad_norm: Optional[int] = 1,
-                         grad_norm_val: Optional[float] = -1.) \
+                         grad_norm_val: Optional[float] = -1.,
+                         use_amp: Optional[bool] = False,
+                         scaler: Optional[Any] = None) \
         -> Tuple[Tensor, List[Tensor], List[Tensor], List[str]]:
     """One full epoch passing.
 
@@ -94,24 +135,38 @@ def module_epoch_passing(data: DataLoader,
     :param grad_norm_val: Max value for gradient clipping. If -1, then\
                           no clipping will happen. Defaults to -1. .
     :type grad_norm_val: float
-    :return: Predicted and ground truth values\
+    :param use_amp: Use mixed precision (float16 autocast)?\
+                    Needs PyTorch 1.6 or newer. Defaults to False.
+    :type use_amp: bool
+    :param scaler: Gradient scaler for mixed precision training.\
+                   Defaults to None.
+    :type scaler: torch.cuda.amp.GradScaler|None
+    :return: Predicted indices and ground truth values\
              (if specified).
     :rtype: torch.Tensor, list[torch.Tensor], list[torch.Tensor], list[str]
     """
     has_optimizer = optimizer is not None
     objective_output: Tensor = zeros(len(data))
 
+    amp_context = nullcontext
+    if use_amp:
+        from torch.cuda.amp import autocast
+        amp_context = autocast
+
     output_y_hat = []
     output_y = []
     f_names = []
 
     for i, example in enumerate(data):
-        y_hat, y, f_names_tmp = module_forward_passing(example, module)
+        with amp_context():
+            y_hat, y, f_names_tmp = module_forward_passing(example, module)
         f_names.extend(f_names_tmp)
         y = y[:, 1:]
         try:
-            output_y_hat.extend(y_hat.cpu())
-            output_y.extend(y.cpu())
+            # Keep only the predicted indices, so that the copy is
+            # small and does not depend on the (autocast) dtype.
+            output_y_hat.extend(y_hat.detach().argmax(-1).cpu())
+            output_y.extend(y.detach().cpu())
         except AttributeError:
             pass
         except TypeError:
@@ -119,19 +174,31 @@ def module_epoch_passing(data: DataLoader,
 
         try:
             y_hat = y_hat[:, :y.size()[1], :]
-            loss = objective(y_hat.contiguous().view(-1, y_hat.size()[-1]),
-                             y.contiguous().view(-1))
+            with amp_context():
+                loss = objective(
+                    y_hat.contiguous().view(-1, y_hat.size()[-1]),
+                    y.contiguous().view(-1))
 
             if has_optimizer:
                 optimizer.zero_grad()
-                loss.backward()
+
+                if scaler is not None:
+                    scaler.scale(loss).backward()
+                    # Gradients must be unscaled before clipping
+                    scaler.unscale_(optimizer)
+                else:
+                    loss.backward()
                 
                 if grad_norm_val > -1:
                     clip_grad_norm_(module.parameters(),
                                     max_norm=grad_norm_val,
                                     norm_type=grad_norm)
-                    
-                optimizer.step()
+
+                if scaler is not None:
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    optimizer.step()
 
             objective_output[i] = loss.cpu().item()
 
@@ -157,7 +224,8 @@ def module_forward_passing(data: MutableSequence[Tensor],
     :rtype: torch.Tensor, torch.Tensor, list[str]
     """
     device = next(module.parameters()).device
-    x, y, f_names = [i.to(device) if isinstance(i, Tensor)
+    x, y, f_names = [i.to(device, non_blocking=True)
+                     if isinstance(i, Tensor)
                      else i for i in data]
     return module(x), y, f_names
 